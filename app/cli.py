@@ -10,7 +10,7 @@ import json
 
 import click
 
-from app.sd_mox import SDMox
+from app.sd_mox import SDMox, close_shared_connections
 from app.util import async_to_sync, first_of_month
 
 clickDate = click.DateTime(formats=["%Y-%m-%d"])
@@ -73,14 +73,18 @@ async def set_name(ctx, unit_uuid, new_unit_name, dry_run):
     unit_uuid = str(unit_uuid)
 
     mox = ctx.obj["sdmox"]
-    await mox.rename_unit(
-        unit_uuid, new_unit_name, at=ctx.obj["from_date"], dry_run=dry_run
-    )
+    try:
+        await mox.rename_unit(
+            unit_uuid, new_unit_name, at=ctx.obj["from_date"], dry_run=dry_run
+        )
+    finally:
+        await close_shared_connections()
 
 
 @sd_mox_cli.command()
 @click.pass_context
-def test_amqp_connection(ctx):
+@async_to_sync
+async def test_amqp_connection(ctx):
     """
     Test the AMQP connection.
 
@@ -97,7 +101,10 @@ def test_amqp_connection(ctx):
         </Event>
     """
 
-    mox._call(payload)
+    try:
+        await mox._call(payload)
+    finally:
+        await close_shared_connections()
 
 
 if __name__ == "__main__":
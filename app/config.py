@@ -5,7 +5,14 @@
 from typing import Any, Dict, List, Optional
 from uuid import UUID
 
-from pydantic import AnyHttpUrl, BaseSettings, HttpUrl, PositiveInt, root_validator
+from pydantic import (
+    AnyHttpUrl,
+    BaseSettings,
+    HttpUrl,
+    PositiveFloat,
+    PositiveInt,
+    root_validator,
+)
 from pydantic.main import BaseModel
 from pydantic.tools import parse_obj_as
 from pydantic.types import SecretStr
@@ -39,6 +46,7 @@ class Settings(BaseSettings):
     amqp_virtual_host: str
     amqp_port: Port = Port(5672)
     amqp_check_waittime: PositiveInt = PositiveInt(3)
+    amqp_check_initial_delay: PositiveFloat = PositiveFloat(0.25)
     amqp_check_retries: PositiveInt = PositiveInt(6)
     # If true, the new AQMP TLS system will be used.
     # TODO: remove flag once we have seen the new system work. The flag is necessary for
@@ -47,6 +55,11 @@ class Settings(BaseSettings):
     amqp_use_tls: bool = False
     amqp_tls: AMQPTLS | None = None
 
+    # If true, SD-Mox XML messages are serialized with xmltodict instead of the
+    # string templates in sd_mox_payloads.
+    # TODO: remove flag once we have seen the templated XML work
+    legacy_xml: bool = False
+
     sd_username: str
     sd_password: str
     sd_institution: str
@@ -26,7 +26,7 @@ from structlog.processors import KeyValueRenderer
 
 from app.config import get_settings
 from app.routers import api, trigger_api
-from app.sd_mox import SDMoxError
+from app.sd_mox import SDMoxError, close_shared_connections
 from app.sd_tree_org import department_identifier_list, sd_tree_org
 
 tags_metadata: List[Dict[str, Any]] = [
@@ -62,6 +62,11 @@ async def startup_event():
     get_settings()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_shared_connections()
+
+
 @app.get(
     "/", response_class=RedirectResponse, tags=["Meta"], summary="Redirect to /docs"
 )
@@ -108,7 +113,7 @@ async def sdmox_exception_handler(request: Request, exc: SDMoxError):
     )
 
 
-from pika.exceptions import ProbableAuthenticationError
+from aio_pika.exceptions import ProbableAuthenticationError
 
 
 @app.exception_handler(ProbableAuthenticationError)
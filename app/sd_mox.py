@@ -5,40 +5,296 @@
 import asyncio
 import operator
 import os
+import re
 import ssl
 import tempfile
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 from datetime import date, datetime, time
-from operator import itemgetter
-from typing import Any, Callable, Dict, List, Optional
+from functools import lru_cache, partial
+from typing import Any, Callable, Coroutine, Dict, Hashable, List, Optional
 from typing import OrderedDict as OrderedDictType
-from typing import Tuple, cast
+from typing import Tuple
 from uuid import UUID
 
-import pika
+import aio_pika
+import httpx
 import requests
 import structlog.stdlib
 import xmltodict
 from os2mo_helpers.mora_helpers import MoraHelper
 from ra_utils.headers import TokenSettings
 from sd_connector import SDConnector
-from structlog import get_logger
 
 import app.sd_mox_payloads as smp
-from app.config import Settings, get_settings
-from app.util import get_mora_helper
+from app.config import AMQPTLS, Settings, get_settings
+from app.util import get_mora_helper, today
 
 logger = structlog.stdlib.get_logger()
 
 
 class SDMoxError(Exception):
     def __init__(self, message):
-        logger = get_logger()
         logger.exception(str(message))
         Exception.__init__(self, "SD-Mox: " + str(message))
 
 
+class _ServerNameSSLContext(ssl.SSLContext):
+    """Client SSL context verifying against a fixed server name.
+
+    The AMQP TLS host is not necessarily the name on the broker certificate,
+    and aio-pika always uses the connection host for SNI and verification.
+    """
+
+    def __new__(cls, server_hostname: str):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, server_hostname: str):
+        self.server_hostname = server_hostname
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, **kwargs):
+        kwargs["server_hostname"] = self.server_hostname
+        return super().wrap_bio(incoming, outgoing, server_side, **kwargs)
+
+
+# Default for parent departments not read by the caller, as None means missing
+_NOT_READ: Any = object()
+
+# Valid unit codes, anything else is validated rule by rule in _validate_unit_code
+_UNIT_CODE_RE = re.compile(r"\A[A-Z0-9]{2,4}\Z")
+
+# MO postal addresses as "street[,] zip city", the last two space separated
+_MO_ADDRESS_RE = re.compile(
+    r"\A(?P<street>.*?),? (?P<zip>[^ ]*) (?P<city>[^ ]*)\Z", re.DOTALL
+)
+
+# Fetches an organisational unit along with its addresses
+ORG_UNIT_WITH_ADDRESSES_QUERY = """
+query GetOrgUnitWithAddresses($uuid: UUID!, $date: DateTime!) {
+  org_units(filter: { uuids: [$uuid], from_date: $date, to_date: $date }) {
+    objects {
+      validities {
+        uuid
+        name
+        user_key
+        org_unit_level { uuid }
+        addresses(filter: { from_date: $date, to_date: $date }) {
+          value
+          address_type { scope user_key }
+        }
+      }
+    }
+  }
+}
+"""
+
+# DAR address types in the order they are preferred
+DAR_ADDRESS_TYPES = (
+    "adresser",
+    "adgangsadresser",
+    "historik/adresser",
+    "historik/adgangsadresser",
+)
+
+# Connections shared by all SDMox instances, as {key: (event loop, task)}
+_shared: Dict[Hashable, Tuple[asyncio.AbstractEventLoop, "asyncio.Task[Any]"]] = {}
+
+
+async def _get_shared(
+    key: Hashable, factory: Callable[[], Coroutine[Any, Any, Any]]
+) -> Any:
+    """Get the connection shared under key, creating it with factory on first use.
+
+    Connections are bound to the event loop they were created on, so one made
+    on another (finished) event loop is replaced. Concurrent callers wait for
+    the same connection, and a failed attempt is retried by the next caller.
+    """
+    loop = asyncio.get_running_loop()
+    entry = _shared.get(key)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, loop.create_task(factory()))
+        _shared[key] = entry
+    try:
+        return await asyncio.shield(entry[1])
+    except Exception:
+        if _shared.get(key) is entry:
+            del _shared[key]
+        raise
+
+
+async def close_shared_connections() -> None:
+    """Close the connections shared by SDMox instances on this event loop.
+
+    Should be called on shutdown, connections are reopened on next use.
+    """
+    loop = asyncio.get_running_loop()
+    for key, (owner, task) in list(_shared.items()):
+        if owner is not loop:
+            continue
+        del _shared[key]
+        try:
+            connection = await task
+        except Exception:
+            continue
+        await connection.aclose()
+
+
+async def _http_client(base_url: str, **kwargs) -> httpx.AsyncClient:
+    return httpx.AsyncClient(base_url=base_url, **kwargs)
+
+
+class _AMQPChannel:
+    """A robust AMQP channel, with the queue replies are sent to if any."""
+
+    def __init__(
+        self,
+        connection: aio_pika.abc.AbstractRobustConnection,
+        channel: aio_pika.abc.AbstractChannel,
+        callback_queue: Optional[str] = None,
+    ):
+        self.connection = connection
+        self.channel = channel
+        self.callback_queue = callback_queue
+
+    async def aclose(self) -> None:
+        await self.connection.close()
+
+
+async def _on_amqp_response(message):
+    # We never expect a result from SD!
+    logger.error(message.body)
+    raise SDMoxError("Uventet svar fra SD AMQP")
+
+
+def _department_phone(department: Dict) -> Optional[str]:
+    return department.get("ContactInformation", {}).get(
+        "TelephoneNumberIdentifier", [None]
+    )[0]
+
+
+def _department_postal_address(key: str) -> Callable[[Dict], Optional[str]]:
+    def getter(department: Dict) -> Optional[str]:
+        return department.get("PostalAddress", {}).get(key)
+
+    return getter
+
+
+def _name_differs(actual: str, expected: str) -> bool:
+    # SD has a length limit, so we use startswith instead of equals.
+    return not expected.startswith(actual)
+
+
+# Checks done by _check_department as (getter, expected key, error, comparator),
+# the comparator returns True when the SD value differs from the expected one
+_DEPT_CHECKS: List[
+    Tuple[Callable[[Dict], Any], str, str, Callable[[Any, Any], bool]]
+] = [
+    (
+        operator.methodcaller("get", "ActivationDate"),
+        "activation_date",
+        "Activation Date",
+        operator.ne,
+    ),
+    (
+        operator.methodcaller("get", "DepartmentName"),
+        "unit_name",
+        "Name",
+        _name_differs,
+    ),
+    (
+        operator.methodcaller("get", "DepartmentIdentifier"),
+        "unit_code",
+        "Unit code",
+        operator.ne,
+    ),
+    (
+        operator.methodcaller("get", "DepartmentUUIDIdentifier"),
+        "unit_uuid",
+        "UUID",
+        operator.ne,
+    ),
+    (
+        operator.methodcaller("get", "DepartmentLevelIdentifier"),
+        "unit_level",
+        "Level",
+        operator.ne,
+    ),
+    (_department_phone, "phone", "Phone", operator.ne),
+    (
+        operator.methodcaller("get", "ProductionUnitIdentifier"),
+        "pnummer",
+        "Pnummer",
+        operator.ne,
+    ),
+    (
+        _department_postal_address("StandardAddressIdentifier"),
+        "address",
+        "Address",
+        operator.ne,
+    ),
+    (_department_postal_address("PostalCode"), "zip_code", "Zip code", operator.ne),
+    (
+        _department_postal_address("DistrictName"),
+        "postal_area",
+        "Postal Area",
+        operator.ne,
+    ),
+]
+
+
+def _department_errors(department: Dict, expected: Dict[str, Any]) -> List[str]:
+    """Run _DEPT_CHECKS against an SD department, skipping unset expectations.
+
+    :return: Names of the failed checks, empty list if no errors.
+    """
+    errors = []
+    for getter, key, error, comparator in _DEPT_CHECKS:
+        expected_value = expected.get(key)
+        if expected_value is None:
+            continue
+        actual = getter(department)
+        if comparator(actual, expected_value):
+            logger.error(
+                "Compare failed", error=error, expected=expected_value, actual=actual
+            )
+            errors.append(error)
+    return errors
+
+
+def _department_differs(department: Dict, key: str, expected: Any, error: str) -> bool:
+    actual = department.get(key)
+    if expected is None or actual == expected:
+        return False
+    logger.error("Compare failed", error=error, expected=expected, actual=actual)
+    return True
+
+
+@lru_cache(maxsize=32)
+def _fetch_class_map_cached(mora_url: str, facet_bvn: str) -> Dict[str, str]:
+    """Map user keys to UUIDs for the classes in a MO facet.
+
+    Facets rarely change, so the result is shared by all SDMox instances,
+    see SDMox.invalidate_class_cache. The result must not be modified.
+    """
+    mora_helpers: MoraHelper = get_mora_helper(mora_url)
+
+    classes: List[dict]
+    classes, _ = mora_helpers.read_classes_in_facet(facet_bvn)
+    return {c["user_key"]: c["uuid"] for c in classes}
+
+
+@lru_cache(maxsize=32)
+def _read_ou_levelkeys_cached(
+    mora_url: str, ou_levelkeys: Tuple[str, ...]
+) -> OrderedDictType[str, str]:
+    """Map SD levels to MO org_unit_level UUIDs, ordered as ou_levelkeys.
+
+    The result is shared by all SDMox instances and must not be modified.
+    """
+    classes: Dict[str, str] = _fetch_class_map_cached(mora_url, "org_unit_level")
+    return OrderedDict(map(lambda key: (key, classes[key]), ou_levelkeys))
+
+
 class SDMoxInterface(ABC):
     @abstractmethod
     async def rename_unit(
@@ -89,9 +345,15 @@ class SDMox(SDMoxInterface):
             self.settings.sd_base_url,
         )
 
+        # MO helper is created lazily and reused
+        self._mora_helper: Optional[MoraHelper] = None
+
         # Fetch levels from MO
         self.sd_levels: OrderedDictType[str, str] = self._read_ou_levelkeys()
         self.level_by_uuid: Dict[str, str] = {v: k for k, v in self.sd_levels.items()}
+        self._level_index: Dict[str, int] = {
+            k: i for i, k in enumerate(self.sd_levels.keys())
+        }
 
         # AMQP exchange
         self.exchange_name: str = "org-struktur-changes-topic"
@@ -100,22 +362,28 @@ class SDMox(SDMoxInterface):
             self._update_virkning(from_date)
 
     def _get_mora_helper(self) -> MoraHelper:
-        return get_mora_helper(self.settings.mora_url)
+        if self._mora_helper is None:
+            self._mora_helper = get_mora_helper(self.settings.mora_url)
+        return self._mora_helper
 
     def _fetch_class_map(self, facet_bvn: str) -> Dict[str, str]:
-        mora_helpers: MoraHelper = self._get_mora_helper()
-
-        dict_lookup: Callable[[Any], Tuple[Any, ...]] = itemgetter("user_key", "uuid")
-        classes: List[dict]
-        classes, _ = mora_helpers.read_classes_in_facet(facet_bvn)
-        return dict(map(cast(Callable[[dict], Tuple[str, str]], dict_lookup), classes))
+        return _fetch_class_map_cached(str(self.settings.mora_url), facet_bvn)
 
     def _read_ou_levelkeys(self) -> OrderedDictType[str, str]:
-        classes: Dict[str, str] = self._fetch_class_map("org_unit_level")
-        return OrderedDict(
-            map(lambda key: (key, classes[key]), self.settings.ou_levelkeys)
+        return _read_ou_levelkeys_cached(
+            str(self.settings.mora_url), tuple(self.settings.ou_levelkeys)
         )
 
+    @staticmethod
+    def invalidate_class_cache() -> None:
+        """Forget the MO classes cached across SDMox instances.
+
+        Needed for changes to the facets, such as new levels, to be picked up
+        without restarting.
+        """
+        _fetch_class_map_cached.cache_clear()
+        _read_ou_levelkeys_cached.cache_clear()
+
     def _update_virkning(self, from_date: date, to_date: Optional[date] = None):
         # TODO: This code smells, type analysis found that the types are not right
         #       I decided to go with midnight, but who knows what would be right.
@@ -129,10 +397,15 @@ class SDMox(SDMoxInterface):
             to_date = date(9999, 12, 31)
         if not from_date.day == 1:
             raise SDMoxError("Startdato skal altid være den første i en måned")
+        self._from_date: date = from_date
         self._times = {
             "virk_from": from_date.strftime("%Y-%m-%dT00:00:00.00"),
             "virk_to": to_date.strftime("%Y-%m-%dT00:00:00.00"),
         }
+        # The rendered validities are the same for every message until the
+        # next update, so only render them once
+        self._virkning_xml = smp.sd_virkning_xml(self.virkning)
+        self._times_xml = smp.times_xml_values(**self._times)
 
     # ------------------------ #
     #    Init methods above    #
@@ -140,33 +413,57 @@ class SDMox(SDMoxInterface):
     # AMQP setup methods below #
     # ------------------------ #
 
-    def _amqp_connect(self):
+    def _amqp_tls_settings(self) -> AMQPTLS:
+        tls_settings = self.settings.amqp_tls
+        if tls_settings is None:
+            raise SDMoxError("AMQP TLS er slået til, men ikke konfigureret")
+        return tls_settings
+
+    def _amqp_key(self) -> Tuple:
+        """Key for the AMQP connection shared by SDMox instances."""
+        if self.settings.amqp_use_tls:
+            tls_settings = self._amqp_tls_settings()
+            return (
+                "amqp-tls",
+                tls_settings.host,
+                tls_settings.port,
+                tls_settings.virtual_host,
+                tls_settings.username,
+            )
+        return (
+            "amqp",
+            self.settings.amqp_host,
+            self.settings.amqp_port,
+            self.settings.amqp_virtual_host,
+            self.settings.amqp_username,
+        )
+
+    async def _amqp_connect(self) -> _AMQPChannel:
         """Establish a connection to the AMQP broker."""
         logger.info("Connecting to AMQP...")
 
-        host = self.settings.amqp_host
-        port = self.settings.amqp_port
+        host: str = self.settings.amqp_host
+        port: int = self.settings.amqp_port
         virtual_host = self.settings.amqp_virtual_host
-        credentials = pika.PlainCredentials(
-            self.settings.amqp_username, self.settings.amqp_password
-        )
-        ssl_options = None
+        login = self.settings.amqp_username
+        password = self.settings.amqp_password
+        context = None
 
         # TODO: remove check when we have seen the new AMQP system work
         if self.settings.amqp_use_tls:
             # Use the new AMQP TLS system
             logger.info("Using AMQP TLS settings")
 
-            tls_settings = self.settings.amqp_tls
+            tls_settings = self._amqp_tls_settings()
 
             host = tls_settings.host
             port = tls_settings.port
             virtual_host = tls_settings.virtual_host
-            credentials = pika.PlainCredentials(
-                tls_settings.username, tls_settings.password.get_secret_value()
-            )
+            login = tls_settings.username
+            password = tls_settings.password.get_secret_value()
 
-            context = ssl.create_default_context(cadata=tls_settings.ca.decode())
+            context = _ServerNameSSLContext(tls_settings.server)
+            context.load_verify_locations(cadata=tls_settings.ca.decode())
             with tempfile.NamedTemporaryFile() as cert_file:
                 cert_file.write(tls_settings.cert)
                 cert_file.flush()
@@ -179,45 +476,35 @@ class SDMox(SDMoxInterface):
                         keyfile=key_file.name,
                     )
 
-            ssl_options = pika.SSLOptions(
-                context=context, server_hostname=tls_settings.server
-            )
-
-        parameters = pika.ConnectionParameters(
-            host=host,
-            port=port,
-            virtual_host=virtual_host,
-            credentials=credentials,
-            ssl_options=ssl_options,
-        )
-
         try:
-            connection = pika.BlockingConnection(parameters)
+            connection = await aio_pika.connect_robust(
+                host=host,
+                port=port,
+                virtualhost=virtual_host,
+                login=login,
+                password=password,
+                ssl=context is not None,
+                ssl_context=context,
+            )
         except Exception as error:
             logger.error("Failed to establish AMQP connection", error=error)
             raise
-        self.channel = connection.channel()
+        channel = await connection.channel()
 
         logger.info(f"AMQP connection established")
 
-        if not self.settings.amqp_use_tls:
-            result = self.channel.queue_declare("", exclusive=True)
-            self.callback_queue = result.method.queue
-            self.channel.basic_consume(
-                queue=self.callback_queue,
-                on_message_callback=self._on_response,
-            )
-
-    def _on_response(self, ch, method, props, body):
-        # We never expect a result from SD!
-        logger = get_logger()
-        logger.error(body)
-        raise SDMoxError("Uventet svar fra SD AMQP")
+        if self.settings.amqp_use_tls:
+            return _AMQPChannel(connection, channel)
+        queue = await channel.declare_queue("", exclusive=True)
+        await queue.consume(_on_amqp_response)
+        return _AMQPChannel(connection, channel, queue.name)
 
-    def _call(self, xml):
-        """Create a connection to SD AMQP and publish a payload.
+    async def _call(self, xml):
+        """Publish a payload to SD AMQP.
 
-        Note: This method makes an AMQP connection on demand.
+        Note: The AMQP connection is made on demand and shared by all SDMox
+        instances with the same AMQP settings, see close_shared_connections.
+        Lost connections are re-established by the robust connection.
 
         Args:
             xml: The XML payload to be published.
@@ -225,36 +512,31 @@ class SDMox(SDMoxInterface):
         Returns:
             True
         """
-        logger = get_logger()
         logger.info("Establishing connection to SD-Mox AMQP")
-        self._amqp_connect()
+        amqp = await _get_shared(self._amqp_key(), self._amqp_connect)
 
         if not self.settings.amqp_use_tls:
-            basic_properties = {
-                "reply_to": self.callback_queue,
-            }
+            message = aio_pika.Message(
+                body=xml.encode("utf-8"),
+                reply_to=amqp.callback_queue,
+            )
+            exchange_name = self.exchange_name
         else:
-            basic_properties = {
-                "content_type": "application/xml",
-                "content_encoding": "utf-8",
-                # delivery_mode=1: Transient (default). The message lives only in
-                #                  memory. If the broker restarts, it's gone.
-                # delivery_mode=2: Persistent. RabbitMQ writes the message to disk as
-                #                  well as keeping it in memory.
-                "delivery_mode": 2,
-            }
+            message = aio_pika.Message(
+                body=xml.encode("utf-8"),
+                content_type="application/xml",
+                content_encoding="utf-8",
+                # NOT_PERSISTENT: Transient (default). The message lives only in
+                #                 memory. If the broker restarts, it's gone.
+                # PERSISTENT:     RabbitMQ writes the message to disk as well as
+                #                 keeping it in memory.
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            )
+            exchange_name = self._amqp_tls_settings().exchange
 
         logger.info("Calling SD-Mox AMQP")
-        self.channel.basic_publish(
-            exchange=(
-                self.exchange_name
-                if not self.settings.amqp_use_tls
-                else self.settings.amqp_tls.exchange
-            ),
-            routing_key="#",
-            properties=pika.BasicProperties(**basic_properties),
-            body=xml,
-        )
+        exchange = await amqp.channel.get_exchange(exchange_name, ensure=False)
+        await exchange.publish(message, routing_key="#")
 
     # ------------------------ #
     # AMQP setup methods above #
@@ -267,10 +549,8 @@ class SDMox(SDMoxInterface):
     ):
         unit_uuid_str = str(unit_uuid)
 
-        mora_helpers = self._get_mora_helper()
-
         # Fetch old ou data
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
+        unit_data, addresses = await self._fetch_ou_with_addresses(unit_uuid_str, at)
         # Change to add our new data
         unit_data["name"] = new_unit_name
 
@@ -282,9 +562,6 @@ class SDMox(SDMoxInterface):
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
-        addresses = mora_helpers.read_ou_address(
-            unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
-        )
         return await self._update_ou(
             unit_uuid_str, unit_data, addresses, dry_run=dry_run
         )
@@ -295,24 +572,28 @@ class SDMox(SDMoxInterface):
         unit_uuid_str = str(unit_uuid)
         new_parent_uuid_str = str(new_parent_uuid)
 
-        mora_helpers = self._get_mora_helper()
-
         # Fetch old ou data
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
+        unit_data = await self._read_ou(unit_uuid_str, at=at)
 
-        # doing a read department here will give the non-unique error
-        # here - where we still have access to the mo-error reporting
+        # Fetch the new parent
+        new_parent_unit = await self._read_ou(new_parent_uuid_str)
+
+        payload = self._payload_create(unit_uuid_str, unit_data, new_parent_unit)
+
+        # Validate the unit code before asking SD for anything, then read the
+        # parent department once and hand it to _move_unit
         code_errors = await self._validate_unit_code(
-            unit_data["user_key"], can_exist=True
+            payload["unit_code"], can_exist=True
         )
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
-
-        # Fetch the new parent
-        new_parent_unit = mora_helpers.read_ou(new_parent_uuid_str)
-
-        payload = self._payload_create(unit_uuid_str, unit_data, new_parent_unit)
-        await self._move_unit(test_run=dry_run, **payload)
+        parent_department = await self._read_department(
+            unit_code=payload["parent"]["unit_code"],
+            unit_level=payload["parent"]["level"],
+        )
+        await self._move_unit(
+            test_run=dry_run, parent_department=parent_department, **payload
+        )
 
         # when moving, do not check against name
         payload["unit_name"] = None
@@ -351,12 +632,8 @@ class SDMox(SDMoxInterface):
         """
         unit_uuid_str = str(unit_uuid)
 
-        mora_helpers = self._get_mora_helper()
-
-        unit_data = mora_helpers.read_ou(unit_uuid_str, at=at)
-
-        previous_addresses = mora_helpers.read_ou_address(
-            unit_uuid_str, at=at, scope=None, return_all=True, reformat=False
+        unit_data, previous_addresses = await self._fetch_ou_with_addresses(
+            unit_uuid_str, at
         )
         # the new address is prepended to addresses and
         # thereby given higher priority in sd_mox.py
@@ -391,6 +668,56 @@ class SDMox(SDMoxInterface):
     #  Helper methods below   #
     # ----------------------- #
 
+    async def _read_ou(self, unit_uuid: str, at: Optional[date] = None) -> Dict:
+        """Read an organizational unit from MO without blocking the event loop."""
+        mora_helpers = self._get_mora_helper()
+        return await asyncio.to_thread(mora_helpers.read_ou, unit_uuid, at=at)
+
+    async def _get_mo_client(self) -> httpx.AsyncClient:
+        mora_url = self.settings.mora_url
+        return await _get_shared(("mo", mora_url), partial(_http_client, mora_url))
+
+    async def _fetch_ou_with_addresses(
+        self, unit_uuid: str, at: Optional[date]
+    ) -> Tuple[Dict, List[Dict]]:
+        """Fetch an organizational unit and its addresses from MO in one query.
+
+        Args:
+            unit_uuid: UUID of the unit to fetch.
+            at: date at which to read the unit, defaults to today.
+
+        Returns:
+            Tuple of the unit data and its addresses, shaped like the output
+            of MoraHelper's read_ou and read_ou_address (with reformat=False).
+        """
+        client = await self._get_mo_client()
+        token_settings = TokenSettings()  # type: ignore[call-arg]
+        # Fetching a token may block on a request to the authentication server
+        headers = await asyncio.to_thread(token_settings.get_headers)
+        response = await client.post(
+            "/graphql/v25",
+            headers=headers,
+            json={
+                "query": ORG_UNIT_WITH_ADDRESSES_QUERY,
+                "variables": {
+                    "uuid": unit_uuid,
+                    "date": datetime.combine(at or today(), time.min).isoformat(),
+                },
+                "operationName": "GetOrgUnitWithAddresses",
+            },
+        )
+        response.raise_for_status()
+        j = response.json()
+        if "errors" in j:
+            raise SDMoxError("Fejlende opslag i MO: {}".format(j["errors"]))
+
+        objects = j["data"]["org_units"]["objects"]
+        if not objects or not objects[0]["validities"]:
+            raise SDMoxError("Enhed ikke fundet i MO: {}".format(unit_uuid))
+        unit_data = objects[0]["validities"][0]
+        addresses = unit_data.pop("addresses")
+        return unit_data, addresses
+
     async def _update_ou(self, unit_uuid, unit_data, addresses, dry_run=False):
         """Update an organizational unit with new unit-data and/or addresses.
 
@@ -404,13 +731,12 @@ class SDMox(SDMoxInterface):
             unit: The SD Organizational unit if changes went well,
                   SDMoxError with description of the issue otherwise.
         """
-        payload = self._payload_edit(unit_uuid, unit_data, addresses)
-        self._edit_unit(test_run=dry_run, **payload)
+        payload = await self._payload_edit(unit_uuid, unit_data, addresses)
+        await self._edit_unit(test_run=dry_run, **payload)
         return await self._check_unit(operation="ret", **payload)
 
     async def _read_parent(self, unit_uuid=None):
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
-        from_date = datetime.strptime(from_date, "%Y-%m-%d").date()
+        from_date = self._from_date
         parent = await self.sd_connector.getDepartmentParent(
             department_uuid_identifier=unit_uuid,
             effective_date=from_date,
@@ -419,9 +745,7 @@ class SDMox(SDMoxInterface):
         return parent_info
 
     async def _read_department(self, unit_code=None, unit_uuid=None, unit_level=None):
-        logger = get_logger()
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
-        from_date = datetime.strptime(from_date, "%Y-%m-%d").date()
+        from_date = self._from_date
         department = await self.sd_connector.getDepartment(
             department_identifier=(unit_uuid or unit_code),
             department_level_identifier=unit_level,
@@ -469,68 +793,35 @@ class SDMox(SDMoxInterface):
         :param operation: flyt, ret, import
         :return: Returns list errors, empty list if no errors.
         """
-        logger = get_logger()
-
-        errors = []
-
-        def compare(actual, expected, error, comparator=None):
-            comparator = comparator or operator.ne
-            if expected is not None and comparator(actual, expected):
-                logger.error(
-                    "Compare failed", error=error, expected=expected, actual=actual
-                )
-                errors.append(error)
-
         department = await self._read_department(
-            unit_code=unit_code, unit_uuid=unit_uuid, unit_level=unit_level
+            unit_code=unit_code,
+            unit_uuid=unit_uuid,
+            unit_level=unit_level,
         )
         if department is None:
             return None, ["Unit"]
 
-        from_date = self.virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"][0:10]
+        expected = {
+            "unit_name": unit_name,
+            "unit_code": unit_code,
+            "unit_uuid": unit_uuid,
+            "unit_level": unit_level,
+            "phone": phone,
+            "pnummer": pnummer,
+        }
         if operation in ("ret", "import"):
-            compare(department.get("ActivationDate"), from_date, "Activation Date")
-        compare(
-            department.get("DepartmentName"),
-            unit_name,
-            "Name",
-            # SD has a length limit, so we use startswith instead of equals.
-            lambda actual, expected: not expected.startswith(actual),
-        )
-        compare(department.get("DepartmentIdentifier"), unit_code, "Unit code")
-        compare(department.get("DepartmentUUIDIdentifier"), unit_uuid, "UUID")
-        compare(department.get("DepartmentLevelIdentifier"), unit_level, "Level")
-        compare(
-            department.get("ContactInformation", {}).get(
-                "TelephoneNumberIdentifier", [None]
-            )[0],
-            phone,
-            "Phone",
-        )
-        compare(department.get("ProductionUnitIdentifier"), pnummer, "Pnummer")
+            expected["activation_date"] = self._from_date.strftime("%Y-%m-%d")
         if adresse:
-            actual = department.get("PostalAddress", {})
-            compare(
-                actual.get("StandardAddressIdentifier"),
-                adresse.get("silkdata:AdresseNavn"),
-                "Address",
-            )
-            compare(
-                actual.get("PostalCode"),
-                adresse.get("silkdata:PostKodeIdentifikator"),
-                "Zip code",
-            )
-            compare(
-                actual.get("DistrictName"),
-                adresse.get("silkdata:ByNavn"),
-                "Postal Area",
-            )
+            expected["address"] = adresse.get("silkdata:AdresseNavn")
+            expected["zip_code"] = adresse.get("silkdata:PostKodeIdentifikator")
+            expected["postal_area"] = adresse.get("silkdata:ByNavn")
+        errors = _department_errors(department, expected)
+
         if parent is not None:
-            parent_uuid = parent["uuid"]
             actual = await self._read_parent(unit_uuid)
-            if actual is not None:
-                compare(actual.get("DepartmentUUIDIdentifier"), parent_uuid, "Parent")
-            else:
+            if actual is None or _department_differs(
+                actual, "DepartmentUUIDIdentifier", parent["uuid"], "Parent"
+            ):
                 errors.append("Parent")
         if not errors:
             logger.info("SD-Mox success", unit_uuid=unit_uuid)
@@ -548,6 +839,50 @@ class SDMox(SDMoxInterface):
         phone=None,
         adresse=None,
         integration_values=None,
+    ):
+        if self.settings.legacy_xml:
+            return self._create_xml_ret_legacy(
+                unit_uuid,
+                unit_code=unit_code,
+                unit_name=unit_name,
+                pnummer=pnummer,
+                phone=phone,
+                adresse=adresse,
+                integration_values=integration_values,
+            )
+
+        virkning = self._virkning_xml
+        registrering_virkning = smp.sd_virkning(datetime.now())
+        values = {
+            "locations": smp.relations_ret_xml(
+                virkning,
+                pnummer=pnummer,
+                phone=phone,
+                adresse=adresse,
+            ),
+            "attributes": smp.attributes_ret_xml(
+                virkning,
+                funktionskode=integration_values["formaalskode"],
+                skolekode=integration_values["skolekode"],
+                unit_name=unit_name,
+            ),
+            "virkning": virkning,
+            "registration_time": smp.xml_text(
+                registrering_virkning["sd:FraTidspunkt"]["sd:TidsstempelDatoTid"]
+            ),
+            "unit_uuid": smp.xml_text(str(unit_uuid)),
+        }
+        return smp.RET_XML_TEMPLATE.format_map(values)
+
+    def _create_xml_ret_legacy(
+        self,
+        unit_uuid,
+        unit_code=None,
+        unit_name=None,
+        pnummer=None,
+        phone=None,
+        adresse=None,
+        integration_values=None,
     ):
         value_dict = {
             "RelationListe": smp.relations_ret(
@@ -574,23 +909,29 @@ class SDMox(SDMoxInterface):
 
     def _create_xml_import(self, **payload):
         payload.update(self._times)
-        import_dict = smp.import_xml_dict(**payload)
-        xml = xmltodict.unparse(import_dict)
-        return xml
+        if self.settings.legacy_xml:
+            import_dict = smp.import_xml_dict(**payload)
+            return xmltodict.unparse(import_dict)
+        values = smp.registrering_xml_values(**payload)
+        values.update(self._times_xml)
+        return smp.IMPORT_XML_TEMPLATE.format_map(values)
 
     def _create_xml_flyt(self, **payload):
         payload.update(self._times)
-        flyt_dict = smp.flyt_xml_dict(**payload)
-        xml = xmltodict.unparse(flyt_dict)
-        return xml
+        if self.settings.legacy_xml:
+            flyt_dict = smp.flyt_xml_dict(**payload)
+            return xmltodict.unparse(flyt_dict)
+        values = smp.registrering_xml_values(**payload)
+        values.update(self._times_xml)
+        return smp.FLYT_XML_TEMPLATE.format_map(values)
 
     async def _validate_unit_code(self, unit_code, unit_level=None, can_exist=False):
-        logger = get_logger()
         logger.info("Validating unit code {}".format(unit_code))
         code_errors = []
         if unit_code is None:
             code_errors.append("Enhedsnummer ikke angivet")
-        else:
+        elif not _UNIT_CODE_RE.match(unit_code):
+            # Find out which of the rules are broken
             if len(unit_code) < 2:
                 code_errors.append("Enhedsnummer for kort")
             elif len(unit_code) > 4:
@@ -612,9 +953,10 @@ class SDMox(SDMoxInterface):
     def _mo_to_sd_address(self, address):
         if address is None:
             return None
-        street, zip_code, city = address.rsplit(" ", maxsplit=2)
-        if street.endswith(","):
-            street = street[:-1]
+        match = _MO_ADDRESS_RE.match(address)
+        if match is None:
+            raise SDMoxError("Ugyldig adresse: {}".format(address))
+        street, zip_code, city = match.groups()
         sd_address = {
             "silkdata:AdresseNavn": street.strip(),
             "silkdata:PostKodeIdentifikator": zip_code.strip(),
@@ -623,7 +965,14 @@ class SDMox(SDMoxInterface):
         return sd_address
 
     async def _create_unit(
-        self, unit_name, unit_code, parent, unit_level, unit_uuid=None, test_run=True
+        self,
+        unit_name,
+        unit_code,
+        parent,
+        unit_level,
+        unit_uuid=None,
+        test_run=True,
+        parent_department=_NOT_READ,
     ):
         """
         Create a new unit in SD.
@@ -635,26 +984,31 @@ class SDMox(SDMoxInterface):
         :param test_run: If true, all validations will be performed, but the
         amqp-call will not be executed, this allows for a pre-check that will
         confirm that the call will most likely succeed.
+        :param parent_department: The SD department of the parent, if already read,
+        None if it does not exist.
         :return: The uuid for the new unit. For test-runs with no provided uuid, this
         will not be the same random uuid as for the actual run, unless the returned
         uuid is stored and given as parameter for the actual run.
         """
-        logger = get_logger()
         code_errors = await self._validate_unit_code(unit_code)
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
         # Verify the parent department actually exist
-        parent_department = await self._read_department(
-            unit_code=parent["unit_code"], unit_level=parent["level"]
-        )
+        if parent_department is _NOT_READ:
+            parent_department = await self._read_department(
+                unit_code=parent["unit_code"], unit_level=parent["level"]
+            )
         if not parent_department:
             raise SDMoxError("Forældrenheden findes ikke")
 
-        unit_index = list(self.sd_levels.keys()).index(unit_level)
-        parent_index = list(self.sd_levels.keys()).index(
-            parent_department["DepartmentLevelIdentifier"]
-        )
+        try:
+            unit_index = self._level_index[unit_level]
+            parent_index = self._level_index[
+                parent_department["DepartmentLevelIdentifier"]
+            ]
+        except KeyError:
+            raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
 
         if not unit_index > parent_index:
             raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
@@ -672,37 +1026,46 @@ class SDMox(SDMoxInterface):
             logger.info(
                 "Create unit {}, {}, {}".format(unit_name, unit_code, unit_uuid)
             )
-            self._call(xml)
+            await self._call(xml)
         return unit_uuid
 
-    def _edit_unit(self, test_run=True, **payload):
-        logger = get_logger()
+    async def _edit_unit(self, test_run=True, **payload):
         xml = self._create_xml_ret(**payload)
         logger.debug("Edit unit xml: {}".format(xml))
         if not test_run:
             logger.info("Edit unit {!r}".format(payload))
-            self._call(xml)
+            await self._call(xml)
         return payload["unit_uuid"]
 
     async def _move_unit(
-        self, unit_name, unit_code, parent, unit_level, unit_uuid=None, test_run=True
+        self,
+        unit_name,
+        unit_code,
+        parent,
+        unit_level,
+        unit_uuid=None,
+        test_run=True,
+        parent_department=_NOT_READ,
     ):
-        logger = get_logger()
         code_errors = await self._validate_unit_code(unit_code, can_exist=True)
         if code_errors:
             raise SDMoxError(", ".join(code_errors))
 
         # Verify the parent department actually exist
-        parent_department = await self._read_department(
-            unit_code=parent["unit_code"], unit_level=parent["level"]
-        )
+        if parent_department is _NOT_READ:
+            parent_department = await self._read_department(
+                unit_code=parent["unit_code"], unit_level=parent["level"]
+            )
         if not parent_department:
             raise SDMoxError("Forældrenheden findes ikke")
 
-        unit_index = list(self.sd_levels.keys()).index(unit_level)
-        parent_index = list(self.sd_levels.keys()).index(
-            parent_department["DepartmentLevelIdentifier"]
-        )
+        try:
+            unit_index = self._level_index[unit_level]
+            parent_index = self._level_index[
+                parent_department["DepartmentLevelIdentifier"]
+            ]
+        except KeyError:
+            raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
         if not unit_index > parent_index:
             raise SDMoxError("Enhedstypen passer ikke til forældreenheden")
 
@@ -716,24 +1079,34 @@ class SDMox(SDMoxInterface):
         )
         logger.debug("Move unit operation", xml=xml)
         if not test_run:
-            self._call(xml)
+            await self._call(xml)
         return unit_uuid
 
     async def _check_unit(self, **payload):
         """Try to have the unit retrieved and compared to the
-        values at hand for as many times
-        as specified in self.amqp_check_retries and return the unit.
+        values at hand for as long as amqp_check_retries times
+        amqp_check_waittime seconds, and return the unit.
+
+        The wait between attempts starts at amqp_check_initial_delay and is
+        doubled after each attempt, up to at most amqp_check_waittime.
 
         Raise an sdMoxError if the unit could not be found or did not have
         the expected attribute values. This error will be shown in the UI
         """
         unit = None
         errors = None
-        for i in range(self.settings.amqp_check_retries):
-            await asyncio.sleep(self.settings.amqp_check_waittime)
+        waittime = self.settings.amqp_check_waittime
+        # Keep the total wait of polling every waittime seconds
+        remaining = self.settings.amqp_check_retries * waittime
+        delay = self.settings.amqp_check_initial_delay
+        while remaining > 0:
+            delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+            remaining -= delay
             unit, errors = await self._check_department(**payload)
-            if unit is not None:
+            if unit is not None and not errors:
                 break
+            delay = min(delay * 2, waittime)
         if unit is None:
             raise SDMoxError("Afdeling ikke fundet: %s" % payload["unit_uuid"])
         elif errors:
@@ -764,22 +1137,33 @@ class SDMox(SDMoxInterface):
             "unit_uuid": unit_uuid,
         }
 
-    def _get_dar_address(self, addrid):
-        for addrtype in (
-            "adresser",
-            "adgangsadresser",
-            "historik/adresser",
-            "historik/adgangsadresser",
-        ):
+    async def _get_dar_client(self) -> httpx.AsyncClient:
+        # Keep connections to DAR alive between lookups, and bound the time
+        # spent waiting on DAR, as an edit waits for all its addresses
+        factory = partial(
+            _http_client,
+            "https://dawa.aws.dk/",
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            timeout=httpx.Timeout(10, connect=3.05),
+        )
+        return await _get_shared(("dar",), factory)
+
+    async def _get_dar_address(self, addrid):
+        """Look up the textual representation of a DAR address by its UUID.
+
+        All address types are queried concurrently, and the first type in
+        DAR_ADDRESS_TYPES with a match wins.
+        """
+        client = await self._get_dar_client()
+        params = [("id", addrid), ("noformat", "1"), ("struktur", "mini")]
+        responses = await asyncio.gather(
+            *(client.get(addrtype, params=params) for addrtype in DAR_ADDRESS_TYPES),
+            return_exceptions=True,
+        )
+        for r in responses:
             try:
-                r = requests.get(
-                    "https://dawa.aws.dk/" + addrtype,
-                    params=[
-                        ("id", addrid),
-                        ("noformat", "1"),
-                        ("struktur", "mini"),
-                    ],
-                )
+                if isinstance(r, BaseException):
+                    raise r
                 addrobjs = r.json()
                 r.raise_for_status()
                 if addrobjs:
@@ -792,19 +1176,22 @@ class SDMox(SDMoxInterface):
 
         return addrobjs.pop()["betegnelse"]
 
-    def _grouped_addresses(self, details):
-        def get_scope_and_key(address_type):
+    async def _grouped_addresses(self, details):
+        async def get_scope_and_key(address_type):
             if len(address_type) > 1:
                 return address_type["scope"], address_type["user_key"]
             # When using the service API, the trigger includes the address_type
             # object. When using GraphQL, it only includes the uuid.
+            return await asyncio.to_thread(lookup_address_type, address_type["uuid"])
+
+        def lookup_address_type(address_type_uuid):
             session = requests.Session()
             session.headers = TokenSettings().get_headers()
             response = session.post(
                 f"{os.getenv('MORA_URL')}/graphql/v25",
                 json={
                     "query": "query GetAddressType($uuid: UUID!) {classes(filter: { uuids: [$uuid] }) {objects {current {user_key scope}}}}",
-                    "variables": {"uuid": address_type["uuid"]},
+                    "variables": {"uuid": address_type_uuid},
                     "operationName": "GetAddressType",
                 },
             )
@@ -813,18 +1200,37 @@ class SDMox(SDMoxInterface):
             current = j["data"]["classes"]["objects"][0]["current"]
             return current["scope"], current["user_key"]
 
+        scopes_and_keys = await asyncio.gather(
+            *(get_scope_and_key(d["address_type"]) for d in details)
+        )
+
+        # Resolve the distinct DAR addresses concurrently. DAR address texts
+        # change over time, so they are not kept beyond this call.
+        dar_ids = list(
+            dict.fromkeys(
+                d["value"]
+                for d, (scope, _) in zip(details, scopes_and_keys)
+                if scope == "DAR"
+            )
+        )
+        dar_addresses = dict(
+            zip(
+                dar_ids,
+                await asyncio.gather(*map(self._get_dar_address, dar_ids)),
+            )
+        )
+
         keyed, scoped = {}, {}
-        for d in details:
-            scope, key = get_scope_and_key(d["address_type"])
+        for d, (scope, key) in zip(details, scopes_and_keys):
             if scope == "DAR":
-                scoped.setdefault(scope, []).append(self._get_dar_address(d["value"]))
+                scoped.setdefault(scope, []).append(dar_addresses[d["value"]])
             else:
                 scoped.setdefault(scope, []).append(d["value"])
             keyed.setdefault(key, []).append(d["value"])
         return scoped, keyed
 
-    def _payload_edit(self, unit_uuid, unit, addresses):
-        scoped, keyed = self._grouped_addresses(addresses)
+    async def _payload_edit(self, unit_uuid, unit, addresses):
+        scoped, keyed = await self._grouped_addresses(addresses)
         if "PNUMBER" in scoped and "DAR" not in scoped:
             # it has proven difficult to deal with pnumber before postal address
             raise SDMoxError("Opret postaddresse før pnummer")
@@ -4,8 +4,9 @@
 
 from collections import OrderedDict
 from datetime import datetime
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Union
 from uuid import UUID
+from xml.sax.saxutils import escape, quoteattr
 
 boilerplate = {
     "@xmlns": "urn:oio:sagdok:organisation:organisationenhed:2.0.0",
@@ -22,6 +23,39 @@ boilerplate = {
     "@xsi:schemaLocation": "urn:oio:sagdok:organisation:organisationenhed:2.0.0 OrganisationEnhedRegistrering.xsd urn:oio:silkdata:1.0.0 SDObjekt.xsd",  # noqa
 }
 
+flyt_namespaces = {
+    "@xmlns": "urn:oio:sagdok:organisation:organisationenhed:2.0.0",
+    "@xmlns:cvr": "http://rep.oio.dk/cvr.dk/xml/schemas/2005/03/22/",
+    "@xmlns:dkcc1": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2003/02/13/",
+    "@xmlns:dkcc2": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2005/03/15/",
+    "@xmlns:itst1": "http://rep.oio.dk/itst.dk/xml/schemas/2005/06/24/",
+    "@xmlns:oio": "urn:oio:definitions:1.0.0",
+    "@xmlns:orgfaelles": "urn:oio:sagdok:organisation:2.0.0",
+    "@xmlns:sd": "urn:oio:sagdok:3.0.0",
+    "@xmlns:sd20070301": "http://rep.oio.dk/sd.dk/xml.schema/20070301/",
+    "@xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "@xsi:schemaLocation": "urn:oio:sagdok:organisation:organisationenhed:2.0.0 "
+    "OrganisationEnhedRegistrering.xsd",
+}
+
+import_namespaces = {
+    "@xmlns": "urn:oio:sagdok:organisation:organisationenhed:2.0.0",
+    "@xmlns:cvr": "http://rep.oio.dk/cvr.dk/xml/schemas/2005/03/22/",
+    "@xmlns:dkcc1": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2003/02/13/",
+    "@xmlns:dkcc2": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2005/03/15/",
+    "@xmlns:itst1": "http://rep.oio.dk/itst.dk/xml/schemas/2005/06/24/",
+    "@xmlns:oio": "urn:oio:definitions:1.0.0",
+    "@xmlns:orgfaelles": "urn:oio:sagdok:organisation:2.0.0",
+    "@xmlns:sd": "urn:oio:sagdok:3.0.0",
+    "@xmlns:sd20070301": "http://rep.oio.dk/sd.dk/xml.schema/20070301/",
+    "@xmlns:silkdata": "urn:oio:silkdata:1.0.0",
+    "@xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "@xsi:schemaLocation": "urn:oio:sagdok:organisation:organisationenhed:2.0.0 "
+    "OrganisationEnhedRegistrering.xsd "
+    "urn:oio:silkdata:1.0.0 "
+    "SDObjekt.xsd",
+}
+
 
 def sd_virkning(from_time: datetime, to_time: Optional[datetime] = None):
     from_string = datetime.strftime(from_time, "%Y-%m-%dT%H:%M:%S.00")
@@ -103,24 +137,7 @@ def flyt_xml_dict(
     parent_unit_uuid=None,
     **kwargs
 ):
-    reg = {
-        "RegistreringBesked": OrderedDict(
-            {
-                "@xmlns": "urn:oio:sagdok:organisation:organisationenhed:2.0.0",
-                "@xmlns:cvr": "http://rep.oio.dk/cvr.dk/xml/schemas/2005/03/22/",
-                "@xmlns:dkcc1": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2003/02/13/",
-                "@xmlns:dkcc2": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2005/03/15/",
-                "@xmlns:itst1": "http://rep.oio.dk/itst.dk/xml/schemas/2005/06/24/",
-                "@xmlns:oio": "urn:oio:definitions:1.0.0",
-                "@xmlns:orgfaelles": "urn:oio:sagdok:organisation:2.0.0",
-                "@xmlns:sd": "urn:oio:sagdok:3.0.0",
-                "@xmlns:sd20070301": "http://rep.oio.dk/sd.dk/xml.schema/20070301/",
-                "@xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-                "@xsi:schemaLocation": "urn:oio:sagdok:organisation:organisationenhed:2.0.0 "
-                "OrganisationEnhedRegistrering.xsd",
-            }
-        )
-    }
+    reg = {"RegistreringBesked": OrderedDict(flyt_namespaces)}
 
     rb = reg["RegistreringBesked"]
     rb["ObjektID"] = create_objekt_id(unit_uuid)
@@ -170,29 +187,7 @@ def import_xml_dict(
     parent_unit_uuid=None,
     **kwargs
 ):
-    reg = OrderedDict(
-        {
-            "RegistreringBesked": OrderedDict(
-                {
-                    "@xmlns": "urn:oio:sagdok:organisation:organisationenhed:2.0.0",
-                    "@xmlns:cvr": "http://rep.oio.dk/cvr.dk/xml/schemas/2005/03/22/",
-                    "@xmlns:dkcc1": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2003/02/13/",
-                    "@xmlns:dkcc2": "http://rep.oio.dk/ebxml/xml/schemas/dkcc/2005/03/15/",
-                    "@xmlns:itst1": "http://rep.oio.dk/itst.dk/xml/schemas/2005/06/24/",
-                    "@xmlns:oio": "urn:oio:definitions:1.0.0",
-                    "@xmlns:orgfaelles": "urn:oio:sagdok:organisation:2.0.0",
-                    "@xmlns:sd": "urn:oio:sagdok:3.0.0",
-                    "@xmlns:sd20070301": "http://rep.oio.dk/sd.dk/xml.schema/20070301/",
-                    "@xmlns:silkdata": "urn:oio:silkdata:1.0.0",
-                    "@xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-                    "@xsi:schemaLocation": "urn:oio:sagdok:organisation:organisationenhed:2.0.0 "
-                    "OrganisationEnhedRegistrering.xsd "
-                    "urn:oio:silkdata:1.0.0 "
-                    "SDObjekt.xsd",
-                }
-            )
-        }
-    )
+    reg = OrderedDict({"RegistreringBesked": OrderedDict(import_namespaces)})
 
     rb = reg["RegistreringBesked"]
     rb["ObjektID"] = create_objekt_id(unit_uuid)
@@ -281,3 +276,256 @@ def create_registrering(virkning, registry_type):
     }
     registrering.update(sd_virkning(datetime.now()))
     return registrering
+
+
+# XML templates
+#
+# The messages below mirror the dicts built above, as serialized by
+# xmltodict.unparse, but are rendered by plain string formatting.
+# All values must be escaped with xml_text before being formatted in.
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+def xml_text(value: Any) -> str:
+    """Escape a leaf value for use as XML character data.
+
+    None renders as an empty element, just like in xmltodict.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return escape(str(value))
+
+
+def _element(tag: str, content: str = "") -> str:
+    return "<{0}>{1}</{0}>".format(tag, content)
+
+
+def _registrering_besked_template(namespaces: Dict[str, str], body: str) -> str:
+    attributes = "".join(
+        " {}={}".format(key[1:], quoteattr(value)) for key, value in namespaces.items()
+    )
+    # Indentation and line breaks only make the templates readable
+    body = "".join(line.strip() for line in body.splitlines())
+    return (
+        XML_DECLARATION
+        + "<RegistreringBesked"
+        + attributes
+        + ">"
+        + body
+        + "</RegistreringBesked>"
+    )
+
+
+RET_XML_TEMPLATE = _registrering_besked_template(
+    boilerplate,
+    """
+    <RelationListe>
+        <sd:LokalUdvidelse>
+            <silkdata:Lokation>{locations}</silkdata:Lokation>
+        </sd:LokalUdvidelse>
+    </RelationListe>
+    <AttributListe>{attributes}</AttributListe>
+    <Registrering>
+        <sd:LivscyklusKode>Rettet</sd:LivscyklusKode>
+        <TilstandListe>
+            <orgfaelles:Gyldighed>
+                {virkning}
+                <orgfaelles:GyldighedStatusKode>Aktiv</orgfaelles:GyldighedStatusKode>
+            </orgfaelles:Gyldighed>
+        </TilstandListe>
+        <sd:FraTidspunkt>
+            <sd:TidsstempelDatoTid>{registration_time}</sd:TidsstempelDatoTid>
+        </sd:FraTidspunkt>
+    </Registrering>
+    <ObjektID>
+        <sd:UUIDIdentifikator>{unit_uuid}</sd:UUIDIdentifikator>
+        <sd:IdentifikatorType>OrganisationEnhed</sd:IdentifikatorType>
+    </ObjektID>
+    """,
+)
+
+IMPORT_XML_TEMPLATE = _registrering_besked_template(
+    import_namespaces,
+    """
+    <ObjektID>
+        <sd:UUIDIdentifikator>{unit_uuid}</sd:UUIDIdentifikator>
+        <sd:IdentifikatorType>OrganisationEnhed</sd:IdentifikatorType>
+    </ObjektID>
+    <Registrering>
+        <sd:FraTidspunkt>
+            <sd:TidsstempelDatoTid>{virk_from}</sd:TidsstempelDatoTid>
+        </sd:FraTidspunkt>
+        <sd:LivscyklusKode>Opstaaet</sd:LivscyklusKode>
+        <sd:BrugerRef>
+            <sd:IdentifikatorType>ILTEST</sd:IdentifikatorType>
+            <sd:UUIDIdentifikator>3bb66b0d-132d-4b98-a903-ea29f6552mmm</sd:UUIDIdentifikator>
+        </sd:BrugerRef>
+        <AttributListe>
+            <Egenskab>
+                <sd:EnhedNavn>{unit_name}</sd:EnhedNavn>
+                {virkning}
+            </Egenskab>
+            <sd:LokalUdvidelse>
+                <silkdata:Integration>
+                    {virkning}
+                    <silkdata:AttributNavn>EnhedKode</silkdata:AttributNavn>
+                    <silkdata:AttributVaerdi>{unit_code}</silkdata:AttributVaerdi>
+                </silkdata:Integration>
+                <silkdata:Integration>
+                    {virkning}
+                    <silkdata:AttributNavn>Niveau</silkdata:AttributNavn>
+                    <silkdata:AttributVaerdi>{unit_level}</silkdata:AttributVaerdi>
+                </silkdata:Integration>
+            </sd:LokalUdvidelse>
+        </AttributListe>
+        <TilstandListe>
+            <orgfaelles:Gyldighed>
+                <orgfaelles:GyldighedStatusKode>Aktiv</orgfaelles:GyldighedStatusKode>
+                {virkning}
+            </orgfaelles:Gyldighed>
+        </TilstandListe>
+        <RelationListe>
+            <sd:LokalUdvidelse></sd:LokalUdvidelse>
+            <sd:Overordnet>
+                <sd:ReferenceID>
+                    <sd:UUIDIdentifikator>{parent_unit_uuid}</sd:UUIDIdentifikator>
+                </sd:ReferenceID>
+                {virkning}
+            </sd:Overordnet>
+        </RelationListe>
+    </Registrering>
+    """,
+)
+
+FLYT_XML_TEMPLATE = _registrering_besked_template(
+    flyt_namespaces,
+    """
+    <ObjektID>
+        <sd:UUIDIdentifikator>{unit_uuid}</sd:UUIDIdentifikator>
+        <sd:IdentifikatorType>OrganisationEnhed</sd:IdentifikatorType>
+    </ObjektID>
+    <Registrering>
+        <sd:FraTidspunkt>
+            <sd:TidsstempelDatoTid>{virk_from}</sd:TidsstempelDatoTid>
+        </sd:FraTidspunkt>
+        <sd:LivscyklusKode>Flyttet</sd:LivscyklusKode>
+        <sd:BrugerRef>
+            <sd:IdentifikatorType>AD</sd:IdentifikatorType>
+            <sd:UUIDIdentifikator>3bb66b0d-132d-4b98-a903-ea29f6552d53</sd:UUIDIdentifikator>
+        </sd:BrugerRef>
+        <AttributListe>
+            <Egenskab>
+                <sd:EnhedNavn>{unit_name}</sd:EnhedNavn>
+                {virkning}
+            </Egenskab>
+            <sd:LokalUdvidelse></sd:LokalUdvidelse>
+        </AttributListe>
+        <TilstandListe></TilstandListe>
+        <RelationListe>
+            <sd:LokalUdvidelse></sd:LokalUdvidelse>
+            <sd:Overordnet>
+                <sd:ReferenceID>
+                    <sd:UUIDIdentifikator>{parent_unit_uuid}</sd:UUIDIdentifikator>
+                </sd:ReferenceID>
+                {virkning}
+            </sd:Overordnet>
+        </RelationListe>
+    </Registrering>
+    """,
+)
+
+
+def sd_virkning_xml(virkning) -> str:
+    """Render a virkning, as returned by sd_virkning, as XML."""
+    content = ""
+    for key, value in virkning.items():
+        timestamp = xml_text(value["sd:TidsstempelDatoTid"])
+        content += _element(key, _element("sd:TidsstempelDatoTid", timestamp))
+    return _element("sd:Virkning", content)
+
+
+def relations_ret_xml(virkning_xml, pnummer=None, phone=None, adresse=None) -> str:
+    """Render the contents of silkdata:Lokation, see relations_ret."""
+    locations = ""
+    if adresse is not None:
+        fields = "".join(
+            _element(key, xml_text(value))
+            for key, value in adresse.items()
+            if key != "sd:Virkning"
+        )
+        locations += _element("silkdata:DanskAdresse", fields + virkning_xml)
+    if pnummer is not None:
+        locations += _element(
+            "silkdata:ProduktionEnhed",
+            virkning_xml
+            + _element("silkdata:ProduktionEnhedIdentifikator", xml_text(pnummer)),
+        )
+    if phone is not None:
+        locations += _element(
+            "silkdata:Kontakt",
+            virkning_xml
+            + _element("silkdata:LokalTelefonnummerIdentifikator", xml_text(phone)),
+        )
+    return locations
+
+
+def attributes_ret_xml(
+    virkning_xml, funktionskode=None, skolekode=None, unit_name=None
+) -> str:
+    """Render the contents of AttributListe, see attributes_ret."""
+    attributes = {}
+    if funktionskode is not None:
+        attributes["FunktionKode"] = funktionskode
+    if skolekode is not None:
+        attributes["SkoleKode"] = skolekode
+    integration_items = "".join(
+        _element(
+            "silkdata:Integration",
+            virkning_xml
+            + _element("silkdata:AttributNavn", xml_text(key))
+            + _element("silkdata:AttributVaerdi", xml_text(value)),
+        )
+        for key, value in sorted(attributes.items())
+    )
+    attribut_liste = _element("sd:LokalUdvidelse", integration_items)
+    if unit_name:
+        attribut_liste += _element(
+            "Egenskab", _element("sd:EnhedNavn", xml_text(unit_name)) + virkning_xml
+        )
+    return attribut_liste
+
+
+def times_xml_values(virk_from, virk_to) -> Dict[str, str]:
+    """Escaped validity values for IMPORT_XML_TEMPLATE and FLYT_XML_TEMPLATE."""
+    virkning = {
+        "sd:FraTidspunkt": {"sd:TidsstempelDatoTid": virk_from},
+        "sd:TilTidspunkt": {"sd:TidsstempelDatoTid": virk_to},
+    }
+    return {
+        "virk_from": xml_text(virk_from),
+        "virkning": sd_virkning_xml(virkning),
+    }
+
+
+def registrering_xml_values(
+    unit_uuid=None,
+    unit_name=None,
+    unit_code=None,
+    unit_level=None,
+    parent_unit_uuid=None,
+    **kwargs
+) -> Dict[str, str]:
+    """Escaped unit values for IMPORT_XML_TEMPLATE and FLYT_XML_TEMPLATE.
+
+    The validity values are added separately, see times_xml_values.
+    """
+    return {
+        "unit_uuid": xml_text(str(unit_uuid)),
+        "unit_name": xml_text(unit_name),
+        "unit_code": xml_text(unit_code),
+        "unit_level": xml_text(unit_level),
+        "parent_unit_uuid": xml_text(parent_unit_uuid),
+    }
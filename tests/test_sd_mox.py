@@ -2,37 +2,77 @@
 #
 # SPDX-License-Identifier: MPL-2.0
 
+import asyncio
 import datetime
+import json
+import os
 from collections import OrderedDict
+from copy import deepcopy
 from functools import partial
-from os import path
 from typing import OrderedDict as OrderedDictType
-from unittest import TestCase
+from unittest import TestCase, mock
 
+import httpx
 from freezegun import freeze_time
 from xmltodict import parse
 
-import sys
-
-sys.path.insert(0, "app")
-from app.sd_mox import SDMox
+from app.sd_mox import (
+    SDMox,
+    SDMoxError,
+    _department_errors,
+    close_shared_connections,
+)
 
 xmlparse = partial(parse, dict_constructor=dict)
 
 
-def read_file(path):
-    """Read the file at path, and return its contents."""
-    with open(path, "r") as resource_file:
-        return resource_file.read()
+def run(coroutine):
+    """Run coroutine on a new event loop, closing the connections it opens.
+
+    SDMox shares its connections per event loop, and they cannot outlive it.
+    """
+
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await close_shared_connections()
+
+    return asyncio.run(main())
 
 
-script_dir = path.dirname(path.realpath(__file__))
-res_prefix = script_dir + "/res/sd_mox_"
-xml_create = read_file(res_prefix + "create.xml")
-xml_edit_simple = read_file(res_prefix + "edit_simple.xml")
-xml_edit_address = read_file(res_prefix + "edit_address.xml")
-xml_edit_integration_values = read_file(res_prefix + "edit_integration_values.xml")
-xml_move = read_file(res_prefix + "move.xml")
+def read_file(path):
+    """Read the UTF-8 file at path, and return its contents."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size).decode("utf-8")
+    finally:
+        os.close(fd)
+
+
+res_dir = os.path.join(os.path.dirname(__file__), "res")
+res_files = {
+    entry.name: read_file(entry.path)
+    for entry in os.scandir(res_dir)
+    if entry.name.startswith("sd_mox_")
+}
+xml_create = res_files["sd_mox_create.xml"]
+xml_edit_simple = res_files["sd_mox_edit_simple.xml"]
+xml_edit_address = res_files["sd_mox_edit_address.xml"]
+xml_edit_integration_values = res_files["sd_mox_edit_integration_values.xml"]
+xml_move = res_files["sd_mox_move.xml"]
+
+# The expected XML, parsed once for all tests
+PARSED = {
+    name: xmlparse(xml)
+    for name, xml in (
+        ("create", xml_create),
+        ("edit_simple", xml_edit_simple),
+        ("edit_address", xml_edit_address),
+        ("edit_integration_values", xml_edit_integration_values),
+        ("move", xml_move),
+    )
+}
 
 
 unit_parent = {
@@ -43,6 +83,170 @@ unit_parent = {
     "user_key": "user-key-11111",
 }
 
+UNIT_SDM2 = {
+    "name": "A-sdm2",
+    "org_unit_type": {"uuid": "uuid-a"},
+    "org_unit_level": {"uuid": "uuid-b"},
+    "user_key": "user-key-22222",
+}
+
+# The unit as given to _payload_edit, without an org_unit_level
+UNIT_SDM2_EDIT = {
+    "name": "A-sdm2",
+    "org_unit_type": {"uuid": "uuid-a"},
+    "user_key": "user-key-22222",
+}
+
+UNIT_SDM3 = {
+    "name": "A-sdm3",
+    "org_unit_type": {"uuid": "uuid-a"},
+    "user_key": "user-key-33333",
+}
+
+ADDRESSES_GROUPED = [
+    {
+        "address_type": {"scope": "DAR", "user_key": "dar-key-1"},
+        "value": "0a3f507b-6331-32b8-e044-0003ba298018",
+    },
+    {
+        "address_type": {"scope": "DAR", "user_key": "dar-key-2"},
+        "value": "0a3f507b-7750-32b8-e044-0003ba298018",
+    },
+    {
+        "address_type": {"scope": "PHONE", "user_key": "phn-key-1"},
+        "value": "12345678",
+    },
+    {
+        "address_type": {"scope": "PNUMBER", "user_key": "pnum-key-1"},
+        "value": "0123456789",
+    },
+]
+
+ADDRESSES_EDIT = [
+    {
+        "address_type": {"scope": "DAR", "user_key": "dar-userkey-not-used"},
+        "value": "0a3f507b-7750-32b8-e044-0003ba298018",
+    },
+    {
+        "address_type": {"scope": "PHONE", "user_key": "phone-user-key-not-used"},
+        "value": "12345678",
+    },
+    {
+        "address_type": {"scope": "PNUMBER", "user_key": "pnummer-user-key-not-used"},
+        "value": "0123456789",
+    },
+]
+
+ADDRESSES_INTEGRATION_VALUES = [
+    {
+        "address_type": {"scope": "TEXT", "user_key": "Formålskode"},
+        "name": "fkode-name-not-used",
+        "value": "Formål1",
+    },
+    {
+        "address_type": {"scope": "TEXT", "user_key": "Skolekode"},
+        "value": "Skole1",
+    },
+]
+
+EXPECTED_CREATE = {
+    "unit_name": "A-sdm2",
+    "parent": {
+        "level": "Afdelings-niveau",
+        "unit_code": "user-key-11111",
+        "uuid": "12345-11-11-11-12345",
+    },
+    "unit_code": "user-key-22222",
+    "unit_level": "Afdelings-niveau",
+    "unit_uuid": "12345-22-22-22-12345",
+}
+
+EXPECTED_EDIT_SIMPLE = {
+    "unit_name": "A-sdm2",
+    "unit_code": "user-key-22222",
+    "phone": None,
+    "adresse": None,
+    "pnummer": None,
+    "integration_values": {
+        "formaalskode": None,
+        "skolekode": None,
+    },
+    "unit_uuid": "12345-22-22-22-12345",
+}
+
+EXPECTED_EDIT_ADDRESS = {
+    "unit_name": "A-sdm2",
+    "unit_code": "user-key-22222",
+    "phone": "12345678",
+    "adresse": {
+        "silkdata:AdresseNavn": "Toftebjerghaven 4",
+        "silkdata:ByNavn": "Ballerup",
+        "silkdata:PostKodeIdentifikator": "2750",
+    },
+    "pnummer": "0123456789",
+    "integration_values": {
+        "formaalskode": None,
+        "skolekode": None,
+    },
+    "unit_uuid": "12345-22-22-22-12345",
+}
+
+EXPECTED_EDIT_INTEGRATION_VALUES = {
+    "unit_name": "A-sdm3",
+    "unit_code": "user-key-33333",
+    "phone": None,
+    "adresse": None,
+    "pnummer": None,
+    "integration_values": {
+        "formaalskode": "Formål1",
+        "skolekode": "Skole1",
+    },
+    "unit_uuid": "12345-33-33-33-12345",
+}
+
+# (name, unit_uuid, unit, addresses, expected payload, expected XML fixture)
+EDIT_CASES = [
+    (
+        "simple",
+        "12345-22-22-22-12345",
+        UNIT_SDM2_EDIT,
+        [],
+        EXPECTED_EDIT_SIMPLE,
+        "edit_simple",
+    ),
+    (
+        "address",
+        "12345-22-22-22-12345",
+        UNIT_SDM2_EDIT,
+        ADDRESSES_EDIT,
+        EXPECTED_EDIT_ADDRESS,
+        "edit_address",
+    ),
+    (
+        "integration_values",
+        "12345-33-33-33-12345",
+        UNIT_SDM3,
+        ADDRESSES_INTEGRATION_VALUES,
+        EXPECTED_EDIT_INTEGRATION_VALUES,
+        "edit_integration_values",
+    ),
+]
+
+SD_DEPARTMENT = {
+    "ActivationDate": "2019-07-01",
+    "DepartmentName": "A-sdm2",
+    "DepartmentIdentifier": "user-key-22222",
+    "DepartmentUUIDIdentifier": "12345-22-22-22-12345",
+    "DepartmentLevelIdentifier": "Afdelings-niveau",
+    "ContactInformation": {"TelephoneNumberIdentifier": ["12345678"]},
+    "ProductionUnitIdentifier": "0123456789",
+    "PostalAddress": {
+        "StandardAddressIdentifier": "Toftebjerghaven 4",
+        "PostalCode": "2750",
+        "DistrictName": "Ballerup",
+    },
+}
+
 mox_overrides = {
     "triggered_uuids": [],
     "ou_levelkeys": [],
@@ -61,39 +265,29 @@ class TestableSDMox(SDMox):
         return OrderedDict()
 
 
-@freeze_time("2020-01-01 12:00:00")
 class Tests(TestCase):
-    def setUp(self):
-        from_date = datetime.datetime(2019, 7, 1, 0, 0)
-        self.mox = TestableSDMox(from_date, overrides=mox_overrides)
+    @classmethod
+    def setUpClass(cls):
+        # Freeze time once for the whole class, rather than around every test
+        cls._freezer = freeze_time("2020-01-01 12:00:00")
+        cls._freezer.start()
+        cls.addClassCleanup(cls._freezer.stop)
 
-        from collections import OrderedDict
+        from_date = datetime.datetime(2019, 7, 1, 0, 0)
+        cls.mox = TestableSDMox(from_date, overrides=mox_overrides)
 
-        self.mox.sd_levels = OrderedDict([("Afdelings-niveau", "uuid-b")])
-        self.mox.level_by_uuid = {
+        cls.mox.sd_levels = OrderedDict([("Afdelings-niveau", "uuid-b")])
+        cls.mox.level_by_uuid = {
             "uuid-b": "Afdelings-niveau",
         }
+        cls.mox._level_index = {"Afdelings-niveau": 0}
+
+    def assertXMLEqual(self, name, xml):
+        """Assert that xml parses to the expected XML fixture called name."""
+        self.assertEqual(PARSED[name], xmlparse(xml))
 
     def test_grouped_adresses(self):
-        addresses = [
-            {
-                "address_type": {"scope": "DAR", "user_key": "dar-key-1"},
-                "value": "0a3f507b-6331-32b8-e044-0003ba298018",
-            },
-            {
-                "address_type": {"scope": "DAR", "user_key": "dar-key-2"},
-                "value": "0a3f507b-7750-32b8-e044-0003ba298018",
-            },
-            {
-                "address_type": {"scope": "PHONE", "user_key": "phn-key-1"},
-                "value": "12345678",
-            },
-            {
-                "address_type": {"scope": "PNUMBER", "user_key": "pnum-key-1"},
-                "value": "0123456789",
-            },
-        ]
-        scoped, keyed = self.mox._grouped_addresses(addresses)
+        scoped, keyed = run(self.mox._grouped_addresses(ADDRESSES_GROUPED))
 
         self.assertEqual(
             {
@@ -117,35 +311,83 @@ class Tests(TestCase):
             keyed,
         )
 
+    def test_grouped_addresses_looks_up_dar_once(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json=[{"betegnelse": "Vej 1, 2750 Ballerup"}])
+
+        client = httpx.AsyncClient(
+            base_url="https://dawa.aws.dk/", transport=httpx.MockTransport(handler)
+        )
+        addresses = [ADDRESSES_EDIT[0], ADDRESSES_EDIT[0]]
+        with mock.patch.object(self.mox, "_get_dar_client", return_value=client):
+            scoped, _ = run(self.mox._grouped_addresses(addresses))
+
+        self.assertEqual({"DAR": ["Vej 1, 2750 Ballerup"] * 2}, scoped)
+        self.assertEqual(4, len(requests))
+
+    def test_fetch_ou_with_addresses(self):
+        requests = []
+
+        def fetch(response_json):
+            def handler(request):
+                requests.append(request)
+                return httpx.Response(200, json=response_json)
+
+            client = httpx.AsyncClient(
+                base_url="http://mo", transport=httpx.MockTransport(handler)
+            )
+            token_settings = mock.patch(
+                "app.sd_mox.TokenSettings",
+                **{"return_value.get_headers.return_value": {}},
+            )
+            mo_client = mock.patch.object(
+                self.mox, "_get_mo_client", return_value=client
+            )
+            with token_settings, mo_client:
+                return run(
+                    self.mox._fetch_ou_with_addresses(
+                        "12345-22-22-22-12345", datetime.date(2019, 7, 1)
+                    )
+                )
+
+        unit = {
+            "uuid": "12345-22-22-22-12345",
+            "name": "A-sdm2",
+            "user_key": "user-key-22222",
+            "org_unit_level": {"uuid": "uuid-b"},
+        }
+        addresses = [
+            {"value": "12345678", "address_type": {"scope": "PHONE", "user_key": "p"}}
+        ]
+        validities = [{**unit, "addresses": addresses}]
+        response = {"data": {"org_units": {"objects": [{"validities": validities}]}}}
+        self.assertEqual((unit, addresses), fetch(response))
+
+        body = json.loads(requests[0].content)
+        self.assertEqual("/graphql/v25", requests[0].url.path)
+        self.assertEqual("GetOrgUnitWithAddresses", body["operationName"])
+        self.assertEqual(
+            {"uuid": "12345-22-22-22-12345", "date": "2019-07-01T00:00:00"},
+            body["variables"],
+        )
+
+        with self.assertRaisesRegex(SDMoxError, "Enhed ikke fundet i MO"):
+            fetch({"data": {"org_units": {"objects": []}}})
+        with self.assertRaisesRegex(SDMoxError, "Fejlende opslag i MO"):
+            fetch({"errors": [{"message": "Not allowed"}]})
+
     def test_payload_create(self):
         pc = self.mox._payload_create(
             unit_uuid="12345-22-22-22-12345",
-            unit={
-                "name": "A-sdm2",
-                # "uuid": "12345-22-22-22-12345",
-                "org_unit_type": {"uuid": "uuid-a"},
-                "org_unit_level": {"uuid": "uuid-b"},
-                "user_key": "user-key-22222",
-            },
+            unit=UNIT_SDM2,
             parent=unit_parent,
         )
 
-        self.assertEqual(
-            {
-                "unit_name": "A-sdm2",
-                "parent": {
-                    "level": "Afdelings-niveau",
-                    "unit_code": "user-key-11111",
-                    "uuid": "12345-11-11-11-12345",
-                },
-                "unit_code": "user-key-22222",
-                "unit_level": "Afdelings-niveau",
-                "unit_uuid": "12345-22-22-22-12345",
-            },
-            pc,
-        )
+        self.assertEqual(EXPECTED_CREATE, pc)
 
-        expected = xmlparse(xml_create)
         actual = self.mox._create_xml_import(
             unit_name=pc["unit_name"],
             unit_uuid=pc["unit_uuid"],
@@ -153,171 +395,223 @@ class Tests(TestCase):
             unit_level=pc["unit_level"],
             parent=pc["parent"]["uuid"],
         )
-        self.assertEqual(expected, xmlparse(actual))
+        self.assertXMLEqual("create", actual)
 
-    def test_payload_edit_simple(self):
-        pe = self.mox._payload_edit(
+    def test_payload_edit(self):
+        for name, unit_uuid, unit, addresses, expected, fixture in EDIT_CASES:
+            with self.subTest(name):
+                pe = run(
+                    self.mox._payload_edit(
+                        unit_uuid=unit_uuid, unit=unit, addresses=addresses
+                    )
+                )
+                self.assertEqual(expected, pe)
+
+                actual = self.mox._create_xml_ret(**pe)
+                self.assertXMLEqual(fixture, actual)
+
+    def test_payload_move_orgunit(self):
+        pc = self.mox._payload_create(
             unit_uuid="12345-22-22-22-12345",
-            unit={
-                "name": "A-sdm2",
-                "org_unit_type": {"uuid": "uuid-a"},
-                "user_key": "user-key-22222",
-            },
-            addresses=[],
+            unit=UNIT_SDM2,
+            parent=unit_parent,
+        )
+
+        self.assertEqual(EXPECTED_CREATE, pc)
+
+        actual = self.mox._create_xml_flyt(
+            unit_name=pc["unit_name"],
+            unit_uuid=pc["unit_uuid"],
+            unit_code=pc["unit_code"],
+            unit_level=pc["unit_level"],
+            parent_unit_uuid=pc["parent"]["uuid"],
+        )
+        self.assertXMLEqual("move", actual)
+
+    def test_amqp_connection_is_shared(self):
+        connection = mock.AsyncMock()
+        channel = connection.channel.return_value
+        channel.declare_queue.return_value.name = "callback-queue"
+        other_mox = TestableSDMox(
+            datetime.datetime(2019, 7, 1, 0, 0), overrides=mox_overrides
         )
 
+        async def publish():
+            await self.mox._call("<Event/>")
+            await other_mox._call("<Event/>")
+
+        with mock.patch("aio_pika.connect_robust", return_value=connection) as connect:
+            run(publish())
+
+        connect.assert_awaited_once()
+        exchange = channel.get_exchange.return_value
+        self.assertEqual(2, exchange.publish.await_count)
+        connection.close.assert_awaited_once()
+
+    def test_department_errors(self):
+        expected = {
+            "activation_date": "2019-07-01",
+            "unit_code": "user-key-22222",
+            "unit_uuid": "12345-22-22-22-12345",
+            "unit_level": "Afdelings-niveau",
+            "phone": "12345678",
+            "pnummer": "0123456789",
+            "address": "Toftebjerghaven 4",
+            "zip_code": "2750",
+            "postal_area": "Ballerup",
+        }
+        self.assertEqual([], _department_errors(SD_DEPARTMENT, expected))
+
+        # SD truncates long names, so a prefix matches
+        for name, errors in (("A-sdm2 and more", []), ("B-sdm2", ["Name"])):
+            with self.subTest(name):
+                self.assertEqual(
+                    errors, _department_errors(SD_DEPARTMENT, {"unit_name": name})
+                )
+
+        department = {k: v for k, v in SD_DEPARTMENT.items() if k != "PostalAddress"}
         self.assertEqual(
+            ["Address", "Zip code", "Postal Area"],
+            _department_errors(department, expected),
+        )
+        # Unset expectations are not checked
+        self.assertEqual([], _department_errors(department, {"address": None}))
+
+    def test_check_department_parent(self):
+        adresse = {
+            "silkdata:AdresseNavn": "Toftebjerghaven 4",
+            "silkdata:PostKodeIdentifikator": "2750",
+            "silkdata:ByNavn": "Ballerup",
+        }
+        cases = [
+            ("match", {"DepartmentUUIDIdentifier": "parent-uuid"}, "parent-uuid", []),
+            (
+                "mismatch",
+                {"DepartmentUUIDIdentifier": "other"},
+                "parent-uuid",
+                ["Parent"],
+            ),
+            ("unset", {"DepartmentUUIDIdentifier": "other"}, None, []),
+            ("missing", None, "parent-uuid", ["Parent"]),
+        ]
+        for name, sd_parent, parent_uuid, errors in cases:
+            with self.subTest(name), mock.patch.object(
+                self.mox, "_read_department", return_value=SD_DEPARTMENT
+            ), mock.patch.object(self.mox, "_read_parent", return_value=sd_parent):
+                department, actual_errors = run(
+                    self.mox._check_department(
+                        unit_name="A-sdm2",
+                        unit_uuid="12345-22-22-22-12345",
+                        adresse=adresse,
+                        parent={"uuid": parent_uuid},
+                        operation="ret",
+                    )
+                )
+                self.assertEqual(SD_DEPARTMENT, department)
+                self.assertEqual(errors, actual_errors)
+
+    def test_check_unit_polling(self):
+        mismatch = (SD_DEPARTMENT, ["Name"])
+        cases = [
+            # Stops as soon as the unit is found and matches
+            ("match", [(None, ["Unit"]), mismatch, (SD_DEPARTMENT, [])], None),
+            # A mismatch is polled for the whole wait, as SD may still be updating
+            ("mismatch", [mismatch] * 9, "kunne ikke opdateres i SD: Name"),
+            ("missing", [(None, ["Unit"])] * 9, "Afdeling ikke fundet"),
+        ]
+        for name, results, error in cases:
+            sleep = mock.AsyncMock()
+            check = mock.AsyncMock(side_effect=results)
+            patch_check = mock.patch.object(self.mox, "_check_department", check)
+            with self.subTest(name), mock.patch("asyncio.sleep", sleep), patch_check:
+                check_unit = self.mox._check_unit(unit_uuid="12345-22-22-22-12345")
+                if error is None:
+                    self.assertEqual(SD_DEPARTMENT, run(check_unit))
+                else:
+                    with self.assertRaisesRegex(SDMoxError, error):
+                        run(check_unit)
+
+                self.assertEqual(len(results), check.await_count)
+                # Exponential backoff from 0.25 seconds, capped at 3 seconds,
+                # for at most 6 times 3 seconds in total
+                delays = [0.25, 0.5, 1.0, 2.0, 3, 3, 3, 3, 2.25][: len(results)]
+                self.assertEqual(delays, [c.args[0] for c in sleep.await_args_list])
+
+    def test_move_unit_reads_parent_once(self):
+        cases = [
+            # An invalid unit code is rejected before SD is asked for anything
+            ("invalid code", UNIT_SDM2, "Enhedsnummer for langt", 0),
+            # A missing parent is reported without reading it again
+            ("missing parent", {**UNIT_SDM2, "user_key": "AB12"}, "findes ikke", 1),
+        ]
+        for name, unit, error, reads in cases:
+            read_department = mock.AsyncMock(return_value=None)
+            patch_read_ou = mock.patch.object(
+                self.mox, "_read_ou", side_effect=[unit, unit_parent]
+            )
+            patch_read = mock.patch.object(
+                self.mox, "_read_department", read_department
+            )
+            with self.subTest(name), patch_read_ou, patch_read:
+                with self.assertRaisesRegex(SDMoxError, error):
+                    run(
+                        self.mox.move_unit(
+                            "12345-22-22-22-12345",
+                            "12345-11-11-11-12345",
+                            at=datetime.date(2019, 7, 1),
+                            dry_run=True,
+                        )
+                    )
+                self.assertEqual(reads, read_department.await_count)
+
+    def test_xml_templates_match_legacy_xml(self):
+        legacy_mox = TestableSDMox(
+            datetime.datetime(2019, 7, 1, 0, 0),
+            overrides={**mox_overrides, "legacy_xml": True},
+        )
+
+        edit_payloads = [
             {
-                "unit_name": "A-sdm2",
+                "unit_uuid": "12345-22-22-22-12345",
                 "unit_code": "user-key-22222",
+                "unit_name": None,
                 "phone": None,
                 "adresse": None,
                 "pnummer": None,
-                "integration_values": {
-                    "formaalskode": None,
-                    "skolekode": None,
-                },
-                "unit_uuid": "12345-22-22-22-12345",
+                "integration_values": {"formaalskode": None, "skolekode": None},
             },
-            pe,
-        )
-
-        expected = xmlparse(xml_edit_simple)
-        actual = self.mox._create_xml_ret(**pe)
-        self.assertEqual(expected, xmlparse(actual))
-
-    def test_payload_edit_address(self):
-        pe = self.mox._payload_edit(
-            unit_uuid="12345-22-22-22-12345",
-            unit={
-                "name": "A-sdm2",
-                "org_unit_type": {"uuid": "uuid-a"},
-                "user_key": "user-key-22222",
-            },
-            addresses=[
-                {
-                    "address_type": {
-                        "scope": "DAR",
-                        "user_key": "dar-userkey-not-used",
-                    },
-                    "value": "0a3f507b-7750-32b8-e044-0003ba298018",
-                },
-                {
-                    "address_type": {
-                        "scope": "PHONE",
-                        "user_key": "phone-user-key-not-used",
-                    },
-                    "value": "12345678",
-                },
-                {
-                    "address_type": {
-                        "scope": "PNUMBER",
-                        "user_key": "pnummer-user-key-not-used",
-                    },
-                    "value": "0123456789",
-                },
-            ],
-        )
-
-        self.assertEqual(
             {
-                "unit_name": "A-sdm2",
-                "unit_code": "user-key-22222",
+                "unit_uuid": "12345-33-33-33-12345",
+                "unit_code": "user-key-33333",
+                "unit_name": "A & <B>",
                 "phone": "12345678",
                 "adresse": {
                     "silkdata:AdresseNavn": "Toftebjerghaven 4",
-                    "silkdata:ByNavn": "Ballerup",
                     "silkdata:PostKodeIdentifikator": "2750",
+                    "silkdata:ByNavn": "Ballerup",
                 },
                 "pnummer": "0123456789",
-                "integration_values": {
-                    "formaalskode": None,
-                    "skolekode": None,
-                },
-                "unit_uuid": "12345-22-22-22-12345",
-            },
-            pe,
-        )
-
-        expected = xmlparse(xml_edit_address)
-        actual = self.mox._create_xml_ret(**pe)
-        self.assertEqual(expected, xmlparse(actual))
-
-    def test_payload_edit_integration_values(self):
-        pe = self.mox._payload_edit(
-            unit_uuid="12345-33-33-33-12345",
-            unit={
-                "name": "A-sdm3",
-                "org_unit_type": {"uuid": "uuid-a"},
-                "user_key": "user-key-33333",
+                "integration_values": {"formaalskode": "F&1", "skolekode": "S<1"},
             },
-            addresses=[
-                {
-                    "address_type": {"scope": "TEXT", "user_key": "Formålskode"},
-                    "name": "fkode-name-not-used",
-                    "value": "Formål1",
-                },
-                {
-                    "address_type": {"scope": "TEXT", "user_key": "Skolekode"},
-                    "value": "Skole1",
-                },
-            ],
-        )
-
+        ]
+        for payload in edit_payloads:
+            self.assertEqual(
+                legacy_mox._create_xml_ret(**deepcopy(payload)),
+                self.mox._create_xml_ret(**deepcopy(payload)),
+            )
+
+        unit_payload = {
+            "unit_name": "A & <B>",
+            "unit_uuid": "12345-22-22-22-12345",
+            "unit_code": "user-key-22222",
+            "unit_level": "Afdelings-niveau",
+            "parent_unit_uuid": "12345-11-11-11-12345",
+        }
         self.assertEqual(
-            {
-                "unit_name": "A-sdm3",
-                "unit_code": "user-key-33333",
-                "phone": None,
-                "adresse": None,
-                "pnummer": None,
-                "integration_values": {
-                    "formaalskode": "Formål1",
-                    "skolekode": "Skole1",
-                },
-                "unit_uuid": "12345-33-33-33-12345",
-            },
-            pe,
-        )
-
-        expected = xmlparse(xml_edit_integration_values)
-        actual = self.mox._create_xml_ret(**pe)
-        self.assertEqual(expected, xmlparse(actual))
-
-    def test_payload_move_orgunit(self):
-        pc = self.mox._payload_create(
-            unit_uuid="12345-22-22-22-12345",
-            unit={
-                "name": "A-sdm2",
-                # "uuid": "12345-22-22-22-12345",
-                "org_unit_type": {"uuid": "uuid-a"},
-                "org_unit_level": {"uuid": "uuid-b"},
-                "user_key": "user-key-22222",
-            },
-            parent=unit_parent,
+            legacy_mox._create_xml_import(**unit_payload),
+            self.mox._create_xml_import(**unit_payload),
         )
-
         self.assertEqual(
-            {
-                "unit_name": "A-sdm2",
-                "parent": {
-                    "level": "Afdelings-niveau",
-                    "unit_code": "user-key-11111",
-                    "uuid": "12345-11-11-11-12345",
-                },
-                "unit_code": "user-key-22222",
-                "unit_level": "Afdelings-niveau",
-                "unit_uuid": "12345-22-22-22-12345",
-            },
-            pc,
-        )
-
-        expected = xmlparse(xml_move)
-        actual = self.mox._create_xml_flyt(
-            unit_name=pc["unit_name"],
-            unit_uuid=pc["unit_uuid"],
-            unit_code=pc["unit_code"],
-            unit_level=pc["unit_level"],
-            parent_unit_uuid=pc["parent"]["uuid"],
+            legacy_mox._create_xml_flyt(**unit_payload),
+            self.mox._create_xml_flyt(**unit_payload),
         )
-        self.assertEqual(expected, xmlparse(actual))